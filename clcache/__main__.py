@@ -10,31 +10,34 @@ from collections import defaultdict, namedtuple
 from ctypes import windll, wintypes
 from shutil import copyfile, copyfileobj, rmtree, which
 import argparse
-import cProfile
 import codecs
 import concurrent.futures
 import contextlib
 import errno
-import gzip
-import hashlib
+import functools
 import json
-import multiprocessing
+import mmap
 import os
-import pickle
 import re
 import subprocess
 import sys
 import threading
+import time
 from tempfile import TemporaryFile
-from typing import Any, List, Tuple, Iterator
+from typing import Any, Dict, List, Optional, Tuple, Iterator
 from atomicwrites import atomic_write
 
-VERSION = "4.2.0-dev"
+from clcache.eventlog import EventLog
+from clcache.hashing import HashAlgorithm
 
-HashAlgorithm = hashlib.md5
+VERSION = "4.2.0-dev"
 
 OUTPUT_LOCK = threading.Lock()
 
+# Modules which are only needed for optional features (compression, the hash
+# server, profiling) are imported where they are used, since importing
+# modules is a noticeable part of the fixed cost of every clcache invocation.
+
 # try to use os.scandir or scandir.scandir
 # fall back to os.listdir if not found
 # same for scandir.walk
@@ -58,6 +61,10 @@ CACHE_COMPILER_OUTPUT_STORAGE_CODEC = 'utf-8'
 # The cl default codec
 CL_DEFAULT_CODEC = 'mbcs'
 
+# Size of the chunks in which streamed compiler output (e.g. the preprocessed
+# source code when computing cache keys in non-direct mode) is read.
+COMPILER_OUTPUT_CHUNK_SIZE = 64 * 1024
+
 # Manifest file will have at most this number of hash lists in it. Need to avoi
 # manifests grow too large.
 MAX_MANIFEST_HASHES = 100
@@ -79,6 +86,22 @@ ManifestEntry = namedtuple('ManifestEntry', ['includeFiles', 'includesContentHas
 
 CompilerArtifacts = namedtuple('CompilerArtifacts', ['objectFilePath', 'stdout', 'stderr'])
 
+# If at least this many files passed to getFileHashes() were not hashed by
+# this process before, they are hashed using multiple threads
+PARALLEL_FILE_HASHING_THRESHOLD = 32
+PARALLEL_FILE_HASHING_WORKERS = min(8, os.cpu_count() or 1)
+FILE_HASHING_EXECUTOR = None # type: Optional[concurrent.futures.ThreadPoolExecutor]
+FILE_HASHING_EXECUTOR_LOCK = threading.Lock()
+
+# Files of at least this size are hashed via a memory mapping, see getFileHash()
+MMAP_FILE_HASHING_THRESHOLD = 64 * 1024
+
+# Hashes of files computed by this process, keyed by path. Each value is a
+# pair of the (mtime, size) fingerprint of the file at hashing time and the
+# hash itself, so that a header is hashed only once per invocation even if
+# many manifest entries or source files (e.g. with /MP) refer to it.
+FILE_HASH_CACHE = {} # type: Dict[str, Tuple[Tuple[int, int], str]]
+
 def printBinary(stream, rawData):
     with OUTPUT_LOCK:
         stream.buffer.write(rawData)
@@ -96,16 +119,45 @@ def filesBeneath(baseDir):
             yield os.path.join(path, filename)
 
 
+# Mimics the os.DirEntry objects yielded by scandir, see directoryEntries()
+class ListdirEntry:
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+
+    def is_dir(self): # pylint: disable=invalid-name
+        return os.path.isdir(self.path)
+
+    def is_file(self): # pylint: disable=invalid-name
+        return os.path.isfile(self.path)
+
+    def stat(self):
+        return os.stat(self.path)
+
+
+# Yields scandir-like entries for the given directory, even if scandir is not
+# available. With scandir, the type and (on Windows) the stat results of the
+# entries come from the directory listing, which saves system calls.
+def directoryEntries(path):
+    if LIST == os.listdir: # pylint: disable=comparison-with-callable
+        return (ListdirEntry(path, name) for name in LIST(path))
+    return LIST(path)
+
+
 def childDirectories(path, absolute=True):
-    supportsScandir = (LIST != os.listdir) # pylint: disable=comparison-with-callable
-    for entry in LIST(path):
-        if supportsScandir:
-            if entry.is_dir():
-                yield entry.path if absolute else entry.name
-        else:
-            absPath = os.path.join(path, entry)
-            if os.path.isdir(absPath):
-                yield absPath if absolute else entry
+    for entry in directoryEntries(path):
+        if entry.is_dir():
+            yield entry.path if absolute else entry.name
+
+
+# Yields (stat, path) pairs for the files directly in the given directory
+def filesWithStats(path):
+    for entry in directoryEntries(path):
+        try:
+            if entry.is_file():
+                yield entry.stat(), entry.path
+        except OSError:
+            pass
 
 
 def normalizeBaseDir(baseDir):
@@ -185,8 +237,8 @@ class ManifestSection:
     def manifestPath(self, manifestHash):
         return os.path.join(self.manifestSectionDir, manifestHash + ".json")
 
-    def manifestFiles(self):
-        return filesBeneath(self.manifestSectionDir)
+    def manifestFilesWithStats(self):
+        return filesWithStats(self.manifestSectionDir)
 
     def setManifest(self, manifestHash, manifest):
         manifestPath = self.manifestPath(manifestHash)
@@ -200,13 +252,12 @@ class ManifestSection:
 
     def getManifest(self, manifestHash):
         fileName = self.manifestPath(manifestHash)
-        if not os.path.exists(fileName):
-            return None
         try:
             with open(fileName, 'r') as inFile:
                 doc = json.load(inFile)
-                return Manifest([ManifestEntry(e['includeFiles'], e['includesContentHash'], e['objectHash'])
-                                 for e in doc['entries']])
+            touchAccessTime(fileName)
+            return Manifest([ManifestEntry(e['includeFiles'], e['includesContentHash'], e['objectHash'])
+                             for e in doc['entries']])
         except IOError:
             return None
         except ValueError:
@@ -246,11 +297,7 @@ class ManifestRepository:
     def clean(self, maxManifestsSize):
         manifestFileInfos = []
         for section in self.sections():
-            for filePath in section.manifestFiles():
-                try:
-                    manifestFileInfos.append((os.stat(filePath), filePath))
-                except OSError:
-                    pass
+            manifestFileInfos.extend(section.manifestFilesWithStats())
 
         manifestFileInfos.sort(key=lambda t: t[0].st_atime, reverse=True)
 
@@ -387,10 +434,10 @@ class CompilerArtifactsSection:
         # Remove any possible left-over in tempEntryDir from previous executions
         rmtree(tempEntryDir, ignore_errors=True)
         ensureDirectoryExists(tempEntryDir)
+        size = 0
         if artifacts.objectFilePath is not None:
             dstFilePath = os.path.join(tempEntryDir, CompilerArtifactsSection.OBJECT_FILE)
-            copyOrLink(artifacts.objectFilePath, dstFilePath, True)
-            size = os.path.getsize(dstFilePath)
+            size = copyOrLink(artifacts.objectFilePath, dstFilePath, True)
         setCachedCompilerConsoleOutput(os.path.join(tempEntryDir, CompilerArtifactsSection.STDOUT_FILE),
                                        artifacts.stdout)
         if artifacts.stderr != '':
@@ -403,6 +450,7 @@ class CompilerArtifactsSection:
     def getEntry(self, key):
         assert self.hasEntry(key)
         cacheEntryDir = self.cacheEntryDir(key)
+        touchAccessTime(os.path.join(cacheEntryDir, CompilerArtifactsSection.OBJECT_FILE))
         return CompilerArtifacts(
             os.path.join(cacheEntryDir, CompilerArtifactsSection.OBJECT_FILE),
             getCachedCompilerConsoleOutput(os.path.join(cacheEntryDir, CompilerArtifactsSection.STDOUT_FILE)),
@@ -460,52 +508,53 @@ class CompilerArtifactsRepository:
     def computeKeyNodirect(compilerBinary, commandLine, environment):
         ppcmd = ["/EP"] + [arg for arg in commandLine if arg not in ("-c", "/c")]
 
-        returnCode, preprocessedSourceCode, ppStderrBinary = \
-            invokeRealCompiler(compilerBinary, ppcmd, captureOutput=True, outputAsString=False, environment=environment)
-
-        if returnCode != 0:
-            errMsg = ppStderrBinary.decode(CL_DEFAULT_CODEC) + "\nclcache: preprocessor failed"
-            raise CompilerFailedException(returnCode, errMsg)
-
         compilerHash = getCompilerHash(compilerBinary)
         normalizedCmdLine = CompilerArtifactsRepository._normalizedCommandLine(commandLine)
 
         h = HashAlgorithm()
         h.update(compilerHash.encode("UTF-8"))
         h.update(' '.join(normalizedCmdLine).encode("UTF-8"))
-        h.update(preprocessedSourceCode)
+
+        # The preprocessed source code is fed into the hash as it is produced
+        # instead of being buffered in memory first.
+        returnCode, ppStderrBinary = \
+            invokeRealCompilerStreamingOutput(compilerBinary, ppcmd, h.update, environment=environment)
+
+        if returnCode != 0:
+            errMsg = ppStderrBinary.decode(CL_DEFAULT_CODEC) + "\nclcache: preprocessor failed"
+            raise CompilerFailedException(returnCode, errMsg)
+
         return h.hexdigest()
 
-    @staticmethod
-    def _normalizedCommandLine(cmdline):
+    NORMALIZED_ARGS_TO_STRIP = (
         # Remove all arguments from the command line which only influence the
         # preprocessor; the preprocessor's output is already included into the
         # hash sum so we don't have to care about these switches in the
         # command line as well.
-        argsToStrip = ("AI", "C", "E", "P", "FI", "u", "X",
-                       "FU", "D", "EP", "Fx", "U", "I")
+        "AI", "C", "E", "P", "FI", "u", "X", "FU", "D", "EP", "Fx", "U", "I",
 
         # Also remove the switch for specifying the output file name; we don't
         # want two invocations which are identical except for the output file
         # name to be treated differently.
-        argsToStrip += ("Fo",)
+        "Fo",
 
         # Also strip the switch for specifying the number of parallel compiler
         # processes to use (when specifying multiple source files on the
         # command line).
-        argsToStrip += ("MP",)
+        "MP",
+    )
 
+    @staticmethod
+    def _normalizedCommandLine(cmdline):
+        argsToStrip = CompilerArtifactsRepository.NORMALIZED_ARGS_TO_STRIP
         return [arg for arg in cmdline
-                if not (arg[0] in "/-" and arg[1:].startswith(argsToStrip))]
+                if not (arg[0] in "/-" and arg.startswith(argsToStrip, 1))]
 
 class CacheFileStrategy:
     def __init__(self, cacheDirectory=None):
         self.dir = cacheDirectory
         if not self.dir:
-            try:
-                self.dir = os.environ["CLCACHE_DIR"]
-            except KeyError:
-                self.dir = os.path.join(os.path.expanduser("~"), "clcache")
+            self.dir = os.environ.get("CLCACHE_DIR") or os.path.join(os.path.expanduser("~"), "clcache")
 
         manifestsRootDir = os.path.join(self.dir, "manifests")
         ensureDirectoryExists(manifestsRootDir)
@@ -660,6 +709,9 @@ class PersistentJSONDict:
                 json.dump(self._dict, f, sort_keys=True, indent=4)
 
     def __setitem__(self, key, value):
+        # Avoid rewriting the file if nothing changed semantically
+        if key in self._dict and self._dict[key] == value:
+            return
         self._dict[key] = value
         self._dirty = True
 
@@ -733,8 +785,14 @@ class Statistics:
         CACHE_SIZE,
     }
 
+    # Opening the statistics folds at most this many event logs, so that the
+    # statistics lock is not held for too long when many logs piled up
+    MAX_FOLDED_EVENT_LOGS = 256
+
     def __init__(self, statsFile):
         self._statsFile = statsFile
+        self._eventLog = EventLog(os.path.splitext(statsFile)[0] + ".d")
+        self._eventsPending = False
         self._stats = None
         self.lock = CacheLock.forPath(self._statsFile)
 
@@ -743,6 +801,10 @@ class Statistics:
         for k in Statistics.RESETTABLE_KEYS | Statistics.NON_RESETTABLE_KEYS:
             if k not in self._stats:
                 self._stats[k] = 0
+        events, self._eventsPending = self._eventLog.fold(Statistics.MAX_FOLDED_EVENT_LOGS)
+        for key in events:
+            if key in Statistics.RESETTABLE_KEYS:
+                self._stats[key] += 1
         return self
 
     def __exit__(self, typ, value, traceback):
@@ -752,42 +814,34 @@ class Statistics:
     def __eq__(self, other):
         return type(self) is type(other) and self.__dict__ == other.__dict__
 
+    def recordEvent(self, key):
+        # Counts one occurrence of 'key' the next time the statistics are
+        # opened, without locking them; see EventLog
+        self._eventLog.record(key)
+
+    # Returns whether not all recorded events were folded when the statistics
+    # were opened
+    def hasPendingEvents(self):
+        return self._eventsPending
+
     def numCallsWithInvalidArgument(self):
         return self._stats[Statistics.CALLS_WITH_INVALID_ARGUMENT]
 
-    def registerCallWithInvalidArgument(self):
-        self._stats[Statistics.CALLS_WITH_INVALID_ARGUMENT] += 1
-
     def numCallsWithoutSourceFile(self):
         return self._stats[Statistics.CALLS_WITHOUT_SOURCE_FILE]
 
-    def registerCallWithoutSourceFile(self):
-        self._stats[Statistics.CALLS_WITHOUT_SOURCE_FILE] += 1
-
     def numCallsWithMultipleSourceFiles(self):
         return self._stats[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES]
 
-    def registerCallWithMultipleSourceFiles(self):
-        self._stats[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES] += 1
-
     def numCallsWithPch(self):
         return self._stats[Statistics.CALLS_WITH_PCH]
 
-    def registerCallWithPch(self):
-        self._stats[Statistics.CALLS_WITH_PCH] += 1
-
     def numCallsForLinking(self):
         return self._stats[Statistics.CALLS_FOR_LINKING]
 
-    def registerCallForLinking(self):
-        self._stats[Statistics.CALLS_FOR_LINKING] += 1
-
     def numCallsForExternalDebugInfo(self):
         return self._stats[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO]
 
-    def registerCallForExternalDebugInfo(self):
-        self._stats[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO] += 1
-
     def numEvictedMisses(self):
         return self._stats[Statistics.EVICTED_MISSES]
 
@@ -832,9 +886,6 @@ class Statistics:
     def numCacheHits(self):
         return self._stats[Statistics.CACHE_HITS]
 
-    def registerCacheHit(self):
-        self._stats[Statistics.CACHE_HITS] += 1
-
     def numCacheMisses(self):
         return self._stats[Statistics.CACHE_MISSES]
 
@@ -844,9 +895,6 @@ class Statistics:
     def numCallsForPreprocessing(self):
         return self._stats[Statistics.CALLS_FOR_PREPROCESSING]
 
-    def registerCallForPreprocessing(self):
-        self._stats[Statistics.CALLS_FOR_PREPROCESSING] += 1
-
     def resetCounters(self):
         for k in Statistics.RESETTABLE_KEYS:
             self._stats[k] = 0
@@ -884,6 +932,9 @@ class InvalidArgumentError(AnalysisError):
     pass
 
 
+# The compiler binary does not change during the lifetime of a clcache
+# process, so there is no need to stat it again for every source file.
+@functools.lru_cache(maxsize=None)
 def getCompilerHash(compilerBinary):
     stat = os.stat(compilerBinary)
     data = '|'.join([
@@ -898,6 +949,8 @@ def getCompilerHash(compilerBinary):
 
 def getFileHashes(filePaths):
     if 'CLCACHE_SERVER' in os.environ:
+        import pickle
+
         pipeName = r'\\.\pipe\clcache_srv'
         while True:
             try:
@@ -913,14 +966,61 @@ def getFileHashes(filePaths):
                     windll.kernel32.WaitNamedPipeW(pipeName, NMPWAIT_WAIT_FOREVER)
                 else:
                     raise
+
+    # Only hash files which were not hashed by this process before, or which
+    # changed since. Looking up the memoized hashes is much cheaper than
+    # handing them to the thread pool.
+    hashes = {}
+    fingerprints = {}
+    for filePath in filePaths:
+        stat = os.stat(filePath)
+        fingerprint = (stat.st_mtime_ns, stat.st_size)
+        cachedEntry = FILE_HASH_CACHE.get(filePath)
+        if cachedEntry is not None and cachedEntry[0] == fingerprint:
+            hashes[filePath] = cachedEntry[1]
+        else:
+            fingerprints[filePath] = fingerprint
+
+    missingPaths = list(fingerprints)
+    if len(missingPaths) < PARALLEL_FILE_HASHING_THRESHOLD or PARALLEL_FILE_HASHING_WORKERS == 1:
+        missingHashes = [getFileHash(filePath) for filePath in missingPaths]
     else:
-        return [getFileHash(filePath) for filePath in filePaths]
+        # Reading and hashing files releases the GIL, so hashing the (often
+        # hundreds of) include files of a translation unit benefits from
+        # using a few threads, in particular when they are not cached by the OS.
+        missingHashes = list(getFileHashingExecutor().map(getFileHash, missingPaths))
+
+    for filePath, fileHash in zip(missingPaths, missingHashes):
+        FILE_HASH_CACHE[filePath] = (fingerprints[filePath], fileHash)
+        hashes[filePath] = fileHash
+    return [hashes[filePath] for filePath in filePaths]
+
+
+# The thread pool used by getFileHashes() is shared by all compile jobs of
+# this process (see /MP), so that they don't start threads of their own.
+def getFileHashingExecutor():
+    global FILE_HASHING_EXECUTOR # pylint: disable=global-statement
+    with FILE_HASHING_EXECUTOR_LOCK:
+        if FILE_HASHING_EXECUTOR is None:
+            FILE_HASHING_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+                max_workers=PARALLEL_FILE_HASHING_WORKERS)
+        return FILE_HASHING_EXECUTOR
 
 
 def getFileHash(filePath, additionalData=None):
     hasher = HashAlgorithm()
     with open(filePath, 'rb') as inFile:
-        hasher.update(inFile.read())
+        # Hash large files via a memory mapping, which avoids copying their
+        # contents into a bytes object first. For small files, setting up the
+        # mapping costs more than it saves.
+        if os.fstat(inFile.fileno()).st_size >= MMAP_FILE_HASHING_THRESHOLD:
+            try:
+                with mmap.mmap(inFile.fileno(), 0, access=mmap.ACCESS_READ) as mappedFile:
+                    hasher.update(mappedFile)
+            except OSError:
+                hasher.update(inFile.read())
+        else:
+            hasher.update(inFile.read())
     if additionalData is not None:
         # Encoding of this additional data does not really matter
         # as long as we keep it fixed, otherwise hashes change.
@@ -966,12 +1066,30 @@ def ensureDirectoryExists(path):
             raise
 
 
+# Cleaning the cache evicts the least recently used manifests and objects
+# first, based on their access times. Windows does not update the access time
+# when reading a file by default (see NtfsDisableLastAccessUpdate), so do it
+# explicitly whenever a cache file is used. The modification time is kept.
+def touchAccessTime(path):
+    try:
+        stat = os.stat(path)
+        os.utime(path, ns=(int(time.time() * 1e9), stat.st_mtime_ns))
+    except OSError:
+        pass
+
+
+# Returns the size of the resulting file at dstFilePath, which differs from
+# the size of srcFilePath when compressing or decompressing.
 def copyOrLink(srcFilePath, dstFilePath, writeCache=False):
     ensureDirectoryExists(os.path.dirname(os.path.abspath(dstFilePath)))
 
     if "CLCACHE_HARDLINK" in os.environ:
-        ret = windll.kernel32.CreateHardLinkW(str(dstFilePath), str(srcFilePath), None)
-        if ret != 0:
+        try:
+            os.link(srcFilePath, dstFilePath)
+        except OSError:
+            # E.g. source and destination are on different volumes
+            pass
+        else:
             # Touch the time stamp of the new link so that the build system
             # doesn't confused by a potentially old time on the file. The
             # hard link gets the same timestamp as the cached file.
@@ -979,7 +1097,7 @@ def copyOrLink(srcFilePath, dstFilePath, writeCache=False):
             # the time stamp on the cache (and hence on all over hard
             # links). This shouldn't be a problem though.
             os.utime(dstFilePath, None)
-            return
+            return os.path.getsize(dstFilePath)
 
     # If hardlinking fails for some reason (or it's not enabled), just
     # fall back to moving bytes around. Always to a temporary path first to
@@ -987,20 +1105,27 @@ def copyOrLink(srcFilePath, dstFilePath, writeCache=False):
     tempDst = dstFilePath + '.tmp'
 
     if "CLCACHE_COMPRESS" in os.environ:
+        import gzip
+
         if "CLCACHE_COMPRESSLEVEL" in os.environ:
             compress = int(os.environ["CLCACHE_COMPRESSLEVEL"])
         else:
             compress = 6
 
         if writeCache is True:
-            with open(srcFilePath, 'rb') as fileIn, gzip.open(tempDst, 'wb', compress) as fileOut:
-                copyfileobj(fileIn, fileOut)
+            with open(srcFilePath, 'rb') as fileIn, open(tempDst, 'wb') as rawFileOut:
+                with gzip.GzipFile(fileobj=rawFileOut, mode='wb', compresslevel=compress) as fileOut:
+                    copyfileobj(fileIn, fileOut)
+                size = rawFileOut.tell()
         else:
             with gzip.open(srcFilePath, 'rb', compress) as fileIn, open(tempDst, 'wb') as fileOut:
                 copyfileobj(fileIn, fileOut)
+                size = fileOut.tell()
     else:
         copyfile(srcFilePath, tempDst)
+        size = os.path.getsize(tempDst)
     os.replace(tempDst, dstFilePath)
+    return size
 
 
 def myExecutablePath():
@@ -1014,13 +1139,13 @@ def findCompilerBinary():
         if os.path.basename(path) == path:
             path = which(path)
 
-        return path if os.path.exists(path) else None
+        return path if path and os.path.isfile(path) else None
 
     frozenByPy2Exe = hasattr(sys, "frozen")
 
-    for p in os.environ["PATH"].split(os.pathsep):
+    for p in os.environ.get("PATH", "").split(os.pathsep):
         path = os.path.join(p, "cl.exe")
-        if os.path.exists(path):
+        if os.path.isfile(path):
             if not frozenByPy2Exe:
                 return path
 
@@ -1224,14 +1349,17 @@ class CommandLineAnalyzer:
         ArgumentT4("Xclang"),
     }
     argumentsWithParameterSorted = sorted(argumentsWithParameter, key=len, reverse=True)
+    argumentsWithParameterByName = {arg.name: arg for arg in argumentsWithParameter}
+    # Alternatives are tried from left to right, so sorting them by length
+    # makes the longest matching name win (e.g. /FI rather than /F).
+    argumentsWithParameterRegex = re.compile('|'.join(re.escape(arg.name) for arg in argumentsWithParameterSorted))
 
     @staticmethod
     def _getParameterizedArgumentType(cmdLineArgument):
-        # Sort by length to handle prefixes
-        for arg in CommandLineAnalyzer.argumentsWithParameterSorted:
-            if cmdLineArgument.startswith(arg.name, 1):
-                return arg
-        return None
+        match = CommandLineAnalyzer.argumentsWithParameterRegex.match(cmdLineArgument, 1)
+        if match is None:
+            return None
+        return CommandLineAnalyzer.argumentsWithParameterByName[match.group(0)]
 
     @staticmethod
     def parseArgumentsAndInputFiles(cmdline):
@@ -1334,7 +1462,8 @@ class CommandLineAnalyzer:
         return inputFiles, objectFiles
 
 
-def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False, outputAsString=True, environment=None):
+# Returns the command line and the environment for invoking the real compiler
+def prepareRealCompilerInvocation(compilerBinary, cmdLine, environment):
     realCmdline = [compilerBinary] + cmdLine
     printTraceStatement("Invoking real compiler as {}".format(realCmdline))
 
@@ -1345,6 +1474,12 @@ def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False, outputAsStr
     # we can catch stdout output.
     environment.pop("VS_UNICODE_OUTPUT", None)
 
+    return realCmdline, environment
+
+
+def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False, outputAsString=True, environment=None):
+    realCmdline, environment = prepareRealCompilerInvocation(compilerBinary, cmdLine, environment)
+
     returnCode = None
     stdout = b''
     stderr = b''
@@ -1370,6 +1505,26 @@ def invokeRealCompiler(compilerBinary, cmdLine, captureOutput=False, outputAsStr
 
     return returnCode, stdout, stderr
 
+# Like invokeRealCompiler(), but passes the standard output of the compiler
+# to consumeOutput() in chunks while it is being produced. Returns the exit
+# code and the (binary) standard error output of the compiler.
+def invokeRealCompilerStreamingOutput(compilerBinary, cmdLine, consumeOutput, environment=None):
+    realCmdline, environment = prepareRealCompilerInvocation(compilerBinary, cmdLine, environment)
+
+    # Write stderr to a file so that the compiler cannot block on a full
+    # stderr pipe while we are busy draining stdout.
+    with TemporaryFile() as stderrFile:
+        compilerProcess = subprocess.Popen(realCmdline, stdout=subprocess.PIPE, stderr=stderrFile, env=environment)
+        with compilerProcess.stdout:
+            for chunk in iter(lambda: compilerProcess.stdout.read(COMPILER_OUTPUT_CHUNK_SIZE), b''):
+                consumeOutput(chunk)
+        returnCode = compilerProcess.wait()
+        stderrFile.seek(0)
+        stderr = stderrFile.read()
+
+    printTraceStatement("Real compiler returned code {0:d}".format(returnCode))
+    return returnCode, stderr
+
 # Returns the amount of jobs which should be run in parallel when
 # invoked in batch mode as determined by the /MP argument
 def jobCount(cmdLine):
@@ -1384,12 +1539,18 @@ def jobCount(cmdLine):
     if count != "":
         return int(count)
 
-    # /MP, but no count specified; use CPU count
-    try:
-        return multiprocessing.cpu_count()
-    except NotImplementedError:
-        # not expected to happen
-        return 2
+    # /MP, but no count specified; use CPU count (or 2 in the unexpected
+    # case that it cannot be determined)
+    return os.cpu_count() or 2
+
+# Folds all events recorded since the statistics were last opened. This is done
+# in batches, so that the statistics lock is not held for too long at a time.
+def foldStatisticsEvents(cache):
+    pending = True
+    while pending:
+        with cache.statistics.lock, cache.statistics as stats:
+            pending = stats.hasPendingEvents()
+
 
 def printStatistics(cache):
     template = """
@@ -1413,6 +1574,7 @@ clcache statistics:
     called w/ multiple sources : {}
     called w/ PCH              : {}""".strip()
 
+    foldStatisticsEvents(cache)
     with cache.statistics.lock, cache.statistics as stats, cache.configuration as cfg:
         print(template.format(
             str(cache),
@@ -1435,6 +1597,7 @@ clcache statistics:
 
 
 def resetStatistics(cache):
+    foldStatisticsEvents(cache)
     with cache.statistics.lock, cache.statistics as stats:
         stats.resetCounters()
 
@@ -1449,6 +1612,21 @@ def clearCache(cache):
         cache.clean(stats, 0)
 
 
+# Matches the lines printed by /showIncludes. Example lines:
+# Note: including file:         C:\Program Files (x86)\Microsoft Visual Studio 12.0\VC\INCLUDE\limits.h
+# Hinweis: Einlesen der Datei:   C:\Program Files (x86)\Microsoft Visual Studio 12.0\VC\INCLUDE\iterator
+#
+# So we match
+# - one word (translation of "note")
+# - colon
+# - space
+# - a phrase containing characters and spaces (translation of "including file")
+# - colon
+# - one or more spaces
+# - the file path, starting with a non-whitespace character
+INCLUDE_LINE_REGEX = re.compile(r'^(\w+): ([ \w]+):( +)(?P<file_path>\S.*)$')
+
+
 # Returns pair:
 #   1. set of include filepaths
 #   2. new compiler output
@@ -1457,26 +1635,18 @@ def clearCache(cache):
 def parseIncludesSet(compilerOutput, sourceFile, strip):
     newOutput = []
     includesSet = set()
-
-    # Example lines
-    # Note: including file:         C:\Program Files (x86)\Microsoft Visual Studio 12.0\VC\INCLUDE\limits.h
-    # Hinweis: Einlesen der Datei:   C:\Program Files (x86)\Microsoft Visual Studio 12.0\VC\INCLUDE\iterator
-    #
-    # So we match
-    # - one word (translation of "note")
-    # - colon
-    # - space
-    # - a phrase containing characters and spaces (translation of "including file")
-    # - colon
-    # - one or more spaces
-    # - the file path, starting with a non-whitespace character
-    reFilePath = re.compile(r'^(\w+): ([ \w]+):( +)(?P<file_path>\S.*)$')
+    # Headers are usually reported many times (once per #include), so only
+    # normalize each distinct path once.
+    seenFilePaths = set()
 
     absSourceFile = os.path.normcase(os.path.abspath(sourceFile))
     for line in compilerOutput.splitlines(True):
-        match = reFilePath.match(line.rstrip('\r\n'))
+        match = INCLUDE_LINE_REGEX.match(line.rstrip('\r\n'))
         if match is not None:
             filePath = match.group('file_path')
+            if filePath in seenFilePaths:
+                continue
+            seenFilePaths.add(filePath)
             filePath = os.path.normcase(os.path.abspath(filePath))
             if filePath != absSourceFile:
                 includesSet.add(filePath)
@@ -1506,16 +1676,17 @@ def processCacheHit(cache, objectFile, cachekey):
     printTraceStatement("Reusing cached object for key {} for object file {}".format(cachekey, objectFile))
 
     with cache.lockFor(cachekey):
-        with cache.statistics.lock, cache.statistics as stats:
-            stats.registerCacheHit()
-
-        if os.path.exists(objectFile):
+        try:
             os.remove(objectFile)
+        except FileNotFoundError:
+            pass
 
         cachedArtifacts = cache.getEntry(cachekey)
         copyOrLink(cachedArtifacts.objectFilePath, objectFile)
-        printTraceStatement("Finished. Exit code 0")
-        return 0, cachedArtifacts.stdout, cachedArtifacts.stderr, False
+
+    cache.statistics.recordEvent(Statistics.CACHE_HITS)
+    printTraceStatement("Finished. Exit code 0")
+    return 0, cachedArtifacts.stdout, cachedArtifacts.stderr, False
 
 
 def createManifestEntry(manifestHash, includePaths):
@@ -1628,10 +1799,6 @@ def main():
         return 1
 
 
-def updateCacheStatistics(cache, method):
-    with cache.statistics.lock, cache.statistics as stats:
-        method(stats)
-
 def printOutAndErr(out, err):
     printBinary(sys.stdout, out.encode(CL_DEFAULT_CODEC))
     printBinary(sys.stderr, err.encode(CL_DEFAULT_CODEC))
@@ -1652,27 +1819,27 @@ def processCompileRequest(cache, compiler, args):
         return scheduleJobs(cache, compiler, cmdLine, environment, sourceFiles, objectFiles)
     except InvalidArgumentError:
         printTraceStatement("Cannot cache invocation as {}: invalid argument".format(cmdLine))
-        updateCacheStatistics(cache, Statistics.registerCallWithInvalidArgument)
+        cache.statistics.recordEvent(Statistics.CALLS_WITH_INVALID_ARGUMENT)
     except NoSourceFileError:
         printTraceStatement("Cannot cache invocation as {}: no source file found".format(cmdLine))
-        updateCacheStatistics(cache, Statistics.registerCallWithoutSourceFile)
+        cache.statistics.recordEvent(Statistics.CALLS_WITHOUT_SOURCE_FILE)
     except MultipleSourceFilesComplexError:
         printTraceStatement("Cannot cache invocation as {}: multiple source files found".format(cmdLine))
-        updateCacheStatistics(cache, Statistics.registerCallWithMultipleSourceFiles)
+        cache.statistics.recordEvent(Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES)
     except CalledWithPchError:
         printTraceStatement("Cannot cache invocation as {}: precompiled headers in use".format(cmdLine))
-        updateCacheStatistics(cache, Statistics.registerCallWithPch)
+        cache.statistics.recordEvent(Statistics.CALLS_WITH_PCH)
     except CalledForLinkError:
         printTraceStatement("Cannot cache invocation as {}: called for linking".format(cmdLine))
-        updateCacheStatistics(cache, Statistics.registerCallForLinking)
+        cache.statistics.recordEvent(Statistics.CALLS_FOR_LINKING)
     except ExternalDebugInfoError:
         printTraceStatement(
             "Cannot cache invocation as {}: external debug information (/Zi) is not supported".format(cmdLine)
         )
-        updateCacheStatistics(cache, Statistics.registerCallForExternalDebugInfo)
+        cache.statistics.recordEvent(Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO)
     except CalledForPreprocessingError:
         printTraceStatement("Cannot cache invocation as {}: called for preprocessing".format(cmdLine))
-        updateCacheStatistics(cache, Statistics.registerCallForPreprocessing)
+        cache.statistics.recordEvent(Statistics.CALLS_FOR_PREPROCESSING)
 
     exitCode, out, err = invokeRealCompiler(compiler, args)
     printOutAndErr(out, err)
@@ -1691,6 +1858,11 @@ def scheduleJobs(cache: Any, compiler: str, cmdLine: List[str], environment: Any
     # Filter out all source files from the command line to form baseCmdLine
     baseCmdLine = [arg for arg in filterSourceFiles(cmdLine, sourceFiles) if not arg.startswith('/MP')]
 
+    # Cache instances must not be shared between jobs running in parallel
+    # (e.g. the memcache client is not thread-safe), but the common case of a
+    # single source file can reuse the cache which is already set up.
+    jobCache = cache if len(sourceFiles) == 1 else None
+
     exitCode = 0
     cleanupRequired = False
     with concurrent.futures.ThreadPoolExecutor(max_workers=jobCount(cmdLine)) as executor:
@@ -1699,7 +1871,7 @@ def scheduleJobs(cache: Any, compiler: str, cmdLine: List[str], environment: Any
             jobCmdLine = baseCmdLine + [srcLanguage + srcFile]
             jobs.append(executor.submit(
                 processSingleSource,
-                compiler, jobCmdLine, srcFile, objFile, environment))
+                compiler, jobCmdLine, srcFile, objFile, environment, jobCache))
         for future in concurrent.futures.as_completed(jobs):
             exitCode, out, err, doCleanup = future.result()
             printTraceStatement("Finished. Exit code {0:d}".format(exitCode))
@@ -1714,10 +1886,10 @@ def scheduleJobs(cache: Any, compiler: str, cmdLine: List[str], environment: Any
 
     return exitCode
 
-def processSingleSource(compiler, cmdLine, sourceFile, objectFile, environment):
+def processSingleSource(compiler, cmdLine, sourceFile, objectFile, environment, cache=None):
     try:
         assert objectFile is not None
-        cache = Cache()
+        cache = cache or Cache()
 
         if 'CLCACHE_NODIRECT' in os.environ:
             return processNoDirect(cache, objectFile, compiler, cmdLine, environment)
@@ -1819,6 +1991,8 @@ def ensureArtifactsExist(cache, cachekey, reason, objectFile, compilerResult, ex
 
 if __name__ == '__main__':
     if 'CLCACHE_PROFILE' in os.environ:
+        import cProfile
+
         INVOCATION_HASH = getStringHash(','.join(sys.argv))
         cProfile.run('main()', filename='clcache-{}.prof'.format(INVOCATION_HASH))
     else:
@@ -0,0 +1,70 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+# An event log counts events such as cache hits without locking, reading or
+# rewriting a shared file, so that frequent events do not serialize parallel
+# clcache processes. Every process appends to a log file of its own; the logs
+# are folded (read and removed) later by whoever holds the statistics lock.
+import os
+import threading
+
+# Serializes appending to the log of this process
+APPEND_LOCK = threading.Lock()
+
+
+class EventLog:
+    def __init__(self, directory):
+        self._directory = directory
+
+    def record(self, event):
+        os.makedirs(self._directory, exist_ok=True)
+        logPath = os.path.join(self._directory, "{}.log".format(os.getpid()))
+        with APPEND_LOCK, open(logPath, 'a') as f:
+            f.write(event + "\n")
+
+    # Removes at most 'maxLogs' logs and returns the events recorded in them,
+    # as well as whether more logs may be left. The caller asserts that nobody
+    # else is folding the logs at the same time.
+    def fold(self, maxLogs):
+        try:
+            fileNames = os.listdir(self._directory)
+        except OSError:
+            return [], False
+
+        # Logs are renamed before reading them so that events appended in the
+        # meantime go to a new log. On Windows, renaming fails while the owning
+        # process is appending to its log; such logs are folded next time.
+        # Left-overs of an interrupted folding come first so that they are not
+        # overwritten.
+        staleFoldingPaths = {os.path.join(self._directory, f) for f in fileNames if f.endswith(".folding")}
+        foldingPaths = list(staleFoldingPaths)[:maxLogs]
+        for fileName in fileNames:
+            if len(foldingPaths) >= maxLogs:
+                break
+            if fileName.endswith(".log"):
+                logPath = os.path.join(self._directory, fileName)
+                foldingPath = logPath[:-len(".log")] + ".folding"
+                if foldingPath in staleFoldingPaths:
+                    continue
+                try:
+                    os.replace(logPath, foldingPath)
+                except OSError:
+                    continue
+                foldingPaths.append(foldingPath)
+
+        events = []
+        numFoldedLogs = 0
+        for foldingPath in foldingPaths:
+            try:
+                with open(foldingPath, 'r') as f:
+                    logEvents = f.read().split()
+                os.remove(foldingPath)
+            except OSError:
+                continue
+            events.extend(logEvents)
+            numFoldedLogs += 1
+        return events, len(foldingPaths) >= maxLogs and numFoldedLogs > 0
@@ -0,0 +1,19 @@
+#
+# This file is part of the clcache project.
+#
+# The contents of this file are subject to the BSD 3-Clause License, the
+# full text of which is available in the accompanying LICENSE file at the
+# root directory of this project.
+#
+# The hash algorithm used by both clcache and clcache-server. This module must
+# not depend on anything Windows specific, so that the server can import it.
+import functools
+import hashlib
+
+# BLAKE2b is considerably faster than MD5 on 64 bit CPUs. A digest size of
+# 16 bytes keeps the hex digests (and hence the cache layout) as they were.
+# BLAKE2b is not available before Python 3.6, fall back to MD5 there.
+if hasattr(hashlib, 'blake2b'):
+    HashAlgorithm = functools.partial(hashlib.blake2b, digest_size=16)
+else:
+    HashAlgorithm = hashlib.md5 # type: ignore
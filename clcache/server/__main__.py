@@ -1,6 +1,5 @@
 # We often don't use all members of all the pyuv callbacks
 # pylint: disable=unused-argument
-import hashlib
 import logging
 import os
 import pickle
@@ -10,6 +9,9 @@ import re
 
 import pyuv
 
+from clcache.hashing import HashAlgorithm
+
+
 class HashCache:
     def __init__(self, loop, excludePatterns, disableWatching):
         self._loop = loop
@@ -29,7 +31,7 @@ class HashCache:
             return hashsum
 
         with open(path, 'rb') as f:
-            hashsum = hashlib.md5(f.read()).hexdigest()
+            hashsum = HashAlgorithm(f.read()).hexdigest()
 
         watchedDirectory[basename] = hashsum
         if dirname not in self._watchedDirectories and not self.isExcluded(dirname) and not self._disableWatching:
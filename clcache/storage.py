@@ -181,8 +181,9 @@ class CacheFileWithMemcacheFallbackStrategy:
         return None
 
     def setEntry(self, key, artifacts):
-        self.localCache.setEntry(key, artifacts)
+        size = self.localCache.setEntry(key, artifacts)
         self.remoteCache.setEntry(key, artifacts)
+        return size
 
     def setManifest(self, manifestHash, manifest):
         with self.localCache.manifestLockFor(manifestHash):
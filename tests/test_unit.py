@@ -12,6 +12,7 @@
 from contextlib import contextmanager
 import multiprocessing
 import os
+import sys
 import unittest
 import tempfile
 import shutil
@@ -109,6 +110,78 @@ class TestHelperFunctions(unittest.TestCase):
             self.assertIn(r".\d\4.txt", files)
             self.assertIn(r".\d\e\5.txt", files)
 
+    def testFilesWithStats(self):
+        with cd(os.path.join(ASSETS_DIR, "files-beneath")):
+            files = {path: stat.st_size for stat, path in clcache.filesWithStats("d")}
+            self.assertEqual(files, {os.path.join("d", "4.txt"): os.path.getsize(os.path.join("d", "4.txt"))})
+
+    def testGetFileHashEmptyFile(self):
+        emptyFile = os.path.join(ASSETS_DIR, "empty_file.txt")
+        self.assertEqual(clcache.getFileHash(emptyFile), clcache.HashAlgorithm().hexdigest())
+        self.assertEqual(clcache.getFileHash(emptyFile, "data"), clcache.getStringHash("data"))
+
+    def testGetFileHashLargeFile(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            for size in [clcache.MMAP_FILE_HASHING_THRESHOLD - 1, clcache.MMAP_FILE_HASHING_THRESHOLD]:
+                content = b"x" * size
+                filePath = os.path.join(tempDir, "file{}.bin".format(size))
+                with open(filePath, "wb") as f:
+                    f.write(content)
+                self.assertEqual(clcache.getFileHash(filePath), clcache.HashAlgorithm(content).hexdigest())
+
+    def testGetFileHashesDetectsChanges(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            filePath = os.path.join(tempDir, "header.h")
+            with open(filePath, "w") as f:
+                f.write("#define A 1\n")
+            firstHashes = clcache.getFileHashes([filePath])
+            self.assertEqual(clcache.getFileHashes([filePath]), firstHashes)
+
+            with open(filePath, "w") as f:
+                f.write("#define A 42\n")
+            self.assertNotEqual(clcache.getFileHashes([filePath]), firstHashes)
+            self.assertEqual(clcache.getFileHashes([filePath]), [clcache.getFileHash(filePath)])
+
+    def testGetFileHashesManyFiles(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            filePaths = []
+            for i in range(2 * clcache.PARALLEL_FILE_HASHING_THRESHOLD):
+                filePath = os.path.join(tempDir, "header{}.h".format(i))
+                with open(filePath, "w") as f:
+                    f.write("#define A {}\n".format(i))
+                filePaths.append(filePath)
+
+            self.assertEqual(clcache.getFileHashes(filePaths), [clcache.getFileHash(p) for p in filePaths])
+            reordered = list(reversed(filePaths)) + filePaths[:3]
+            self.assertEqual(clcache.getFileHashes(reordered), [clcache.getFileHash(p) for p in reordered])
+
+            with self.assertRaises(FileNotFoundError):
+                clcache.getFileHashes(filePaths + [os.path.join(tempDir, "missing.h")])
+
+    def testInvokeRealCompilerStreamingOutput(self):
+        outputSize = 3 * clcache.COMPILER_OUTPUT_CHUNK_SIZE + 1
+        script = ("import sys; "
+                  "sys.stdout.buffer.write(b'x' * {}); "
+                  "sys.stderr.buffer.write(b'some error'); "
+                  "sys.exit(3)").format(outputSize)
+        chunks = []
+        returnCode, stderr = clcache.invokeRealCompilerStreamingOutput(
+            sys.executable, ["-c", script], chunks.append, environment=dict(os.environ))
+
+        self.assertEqual(returnCode, 3)
+        self.assertEqual(stderr, b'some error')
+        self.assertEqual(b''.join(chunks), b'x' * outputSize)
+        self.assertTrue(all(len(chunk) <= clcache.COMPILER_OUTPUT_CHUNK_SIZE for chunk in chunks))
+
+    def testFindCompilerBinaryUnresolvableName(self):
+        oldEnviron = dict(os.environ)
+        try:
+            os.environ["CLCACHE_CL"] = "clcache-no-such-compiler.exe"
+            self.assertIsNone(clcache.findCompilerBinary())
+        finally:
+            os.environ.clear()
+            os.environ.update(oldEnviron)
+
 
 class TestExtendCommandLineFromEnvironment(unittest.TestCase):
     def testEmpty(self):
@@ -169,48 +242,101 @@ class TestStatistics(unittest.TestCase):
             pass
 
     def testHitCounts(self):
-        with Statistics(temporaryFileName()) as s:
-            self.assertEqual(s.numCallsWithInvalidArgument(), 0)
-            self.assertEqual(s.numCallsWithoutSourceFile(), 0)
-            self.assertEqual(s.numCallsWithMultipleSourceFiles(), 0)
-            self.assertEqual(s.numCallsWithPch(), 0)
-            self.assertEqual(s.numCallsForLinking(), 0)
-            self.assertEqual(s.numCallsForExternalDebugInfo(), 0)
-            self.assertEqual(s.numEvictedMisses(), 0)
-            self.assertEqual(s.numHeaderChangedMisses(), 0)
-            self.assertEqual(s.numSourceChangedMisses(), 0)
-            self.assertEqual(s.numCacheHits(), 0)
-            self.assertEqual(s.numCacheMisses(), 0)
-            self.assertEqual(s.numCallsForPreprocessing(), 0)
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, "stats.txt")
+            with Statistics(statsFile) as s:
+                self.assertEqual(s.numCallsWithInvalidArgument(), 0)
+                self.assertEqual(s.numCallsWithoutSourceFile(), 0)
+                self.assertEqual(s.numCallsWithMultipleSourceFiles(), 0)
+                self.assertEqual(s.numCallsWithPch(), 0)
+                self.assertEqual(s.numCallsForLinking(), 0)
+                self.assertEqual(s.numCallsForExternalDebugInfo(), 0)
+                self.assertEqual(s.numEvictedMisses(), 0)
+                self.assertEqual(s.numHeaderChangedMisses(), 0)
+                self.assertEqual(s.numSourceChangedMisses(), 0)
+                self.assertEqual(s.numCacheHits(), 0)
+                self.assertEqual(s.numCacheMisses(), 0)
+                self.assertEqual(s.numCallsForPreprocessing(), 0)
 
             # Bump all by 1
-            s.registerCallWithInvalidArgument()
-            s.registerCallWithoutSourceFile()
-            s.registerCallWithMultipleSourceFiles()
-            s.registerCallWithPch()
-            s.registerCallForLinking()
-            s.registerCallForExternalDebugInfo()
-            s.registerEvictedMiss()
-            s.registerHeaderChangedMiss()
-            s.registerSourceChangedMiss()
-            s.registerCacheHit()
-            s.registerCacheMiss()
-            s.registerCallForPreprocessing()
-
-            self.assertEqual(s.numCallsWithInvalidArgument(), 1)
-            self.assertEqual(s.numCallsWithoutSourceFile(), 1)
-            self.assertEqual(s.numCallsWithMultipleSourceFiles(), 1)
-            self.assertEqual(s.numCallsWithPch(), 1)
-            self.assertEqual(s.numCallsForLinking(), 1)
-            self.assertEqual(s.numCallsForExternalDebugInfo(), 1)
-            self.assertEqual(s.numEvictedMisses(), 1)
-            self.assertEqual(s.numHeaderChangedMisses(), 1)
-            self.assertEqual(s.numSourceChangedMisses(), 1)
-            self.assertEqual(s.numCacheHits(), 1)
-            self.assertEqual(s.numCallsForPreprocessing(), 1)
-
-            # accumulated: headerChanged, sourceChanged, eviced, miss
-            self.assertEqual(s.numCacheMisses(), 4)
+            s = Statistics(statsFile)
+            for key in [Statistics.CALLS_WITH_INVALID_ARGUMENT,
+                        Statistics.CALLS_WITHOUT_SOURCE_FILE,
+                        Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES,
+                        Statistics.CALLS_WITH_PCH,
+                        Statistics.CALLS_FOR_LINKING,
+                        Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO,
+                        Statistics.CACHE_HITS,
+                        Statistics.CALLS_FOR_PREPROCESSING]:
+                s.recordEvent(key)
+            with s:
+                s.registerEvictedMiss()
+                s.registerHeaderChangedMiss()
+                s.registerSourceChangedMiss()
+                s.registerCacheMiss()
+
+                self.assertEqual(s.numCallsWithInvalidArgument(), 1)
+                self.assertEqual(s.numCallsWithoutSourceFile(), 1)
+                self.assertEqual(s.numCallsWithMultipleSourceFiles(), 1)
+                self.assertEqual(s.numCallsWithPch(), 1)
+                self.assertEqual(s.numCallsForLinking(), 1)
+                self.assertEqual(s.numCallsForExternalDebugInfo(), 1)
+                self.assertEqual(s.numEvictedMisses(), 1)
+                self.assertEqual(s.numHeaderChangedMisses(), 1)
+                self.assertEqual(s.numSourceChangedMisses(), 1)
+                self.assertEqual(s.numCacheHits(), 1)
+                self.assertEqual(s.numCallsForPreprocessing(), 1)
+
+                # accumulated: headerChanged, sourceChanged, eviced, miss
+                self.assertEqual(s.numCacheMisses(), 4)
+
+    def testRecordEvent(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, "stats.txt")
+            s = Statistics(statsFile)
+            s.recordEvent(Statistics.CACHE_HITS)
+            s.recordEvent(Statistics.CACHE_HITS)
+            s.recordEvent(Statistics.CALLS_FOR_LINKING)
+
+            with s:
+                self.assertEqual(s.numCacheHits(), 2)
+                self.assertEqual(s.numCallsForLinking(), 1)
+                self.assertEqual(s.numCacheMisses(), 0)
+
+            # Events are only counted once
+            with Statistics(statsFile) as s:
+                self.assertEqual(s.numCacheHits(), 2)
+
+            Statistics(statsFile).recordEvent(Statistics.CACHE_HITS)
+            with Statistics(statsFile) as s:
+                self.assertEqual(s.numCacheHits(), 3)
+
+    def testRecordEventManyLogs(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(tempDir)
+            eventsDir = os.path.join(tempDir, "stats.d")
+            os.makedirs(eventsDir)
+            numLogs = 2 * Statistics.MAX_FOLDED_EVENT_LOGS + 1
+            for i in range(numLogs):
+                with open(os.path.join(eventsDir, "{}.log".format(i)), "w") as f:
+                    f.write("CacheHits\nCallsWithPch\n")
+
+            # Recording an event never folds the logs
+            cache.statistics.recordEvent(Statistics.CACHE_HITS)
+            self.assertEqual(len(os.listdir(eventsDir)), numLogs + 1)
+
+            # Each opening of the statistics folds a bounded number of logs
+            with cache.statistics as s:
+                self.assertEqual(s.numCacheHits(), Statistics.MAX_FOLDED_EVENT_LOGS)
+                self.assertTrue(s.hasPendingEvents())
+            self.assertEqual(len(os.listdir(eventsDir)), numLogs + 1 - Statistics.MAX_FOLDED_EVENT_LOGS)
+
+            clcache.foldStatisticsEvents(cache)
+            self.assertEqual(os.listdir(eventsDir), [])
+            with cache.statistics as s:
+                self.assertEqual(s.numCacheHits(), numLogs + 1)
+                self.assertEqual(s.numCallsWithPch(), numLogs)
+                self.assertFalse(s.hasPendingEvents())
 
 
 class TestManifestRepository(unittest.TestCase):
@@ -356,6 +482,34 @@ class TestCompilerArtifactsRepository(unittest.TestCase):
         self.assertEqual(cas.cachedObjectName("fdde59862785f9f0ad6e661b9b5746b7"), os.path.join(
             compilerArtifactsRepositoryRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7", "object"))
 
+    def testNormalizedCommandLine(self):
+        # pylint: disable=protected-access
+        normalize = CompilerArtifactsRepository._normalizedCommandLine
+        self.assertEqual(normalize([]), [])
+        self.assertEqual(normalize(["/c", "/nologo", "main.cpp"]), ["/c", "/nologo", "main.cpp"])
+        self.assertEqual(
+            normalize(["/c", "/DNDEBUG", "-Iinclude", "/Fomain.obj", "/MP4", "/O2", "main.cpp"]),
+            ["/c", "/O2", "main.cpp"])
+
+    def testGetEntryUpdatesAccessTime(self):
+        from clcache.__main__ import CompilerArtifacts
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            objectFile = os.path.join(tempDir, "source.obj")
+            with open(objectFile, "wb") as f:
+                f.write(b"Content")
+
+            key = "fdde59862785f9f0ad6e661b9b5746b7"
+            cas = CompilerArtifactsRepository(os.path.join(tempDir, "objects")).section(key)
+            cas.setEntry(key, CompilerArtifacts(objectFile, "", ""))
+
+            cachedObject = cas.cachedObjectName(key)
+            os.utime(cachedObject, (1000000000, 1000000000))
+            cas.getEntry(key)
+            stat = os.stat(cachedObject)
+            self.assertGreater(stat.st_atime, 1000000000)
+            self.assertEqual(stat.st_mtime, 1000000000)
+
 
 class TestArgumentClasses(unittest.TestCase):
     def testEquality(self):
@@ -958,6 +1112,30 @@ class TestParseIncludes(unittest.TestCase):
             self.assertEqual(len(includesSet), sample['UniqueIncludesCount'])
             self.assertEqual(newCompilerOutput, "main.cpp\n")
 
+    def testParseIncludesRepeatedIncludes(self):
+        sourceFile = os.path.join("src", "main.cpp")
+        header1 = os.path.join("include", "a.h")
+        header2 = os.path.join("include", "b.h")
+        compilerOutput = (
+            "main.cpp\n"
+            "Note: including file: {0}\n"
+            "Note: including file:  {1}\n"
+            "Note: including file: {0}\n"
+            "Note: including file: {2}\n"
+            "main.cpp(3): warning C4101: 'x': unreferenced local variable\n"
+            "Note: including file:  {1}\n"
+        ).format(header1, header2, sourceFile)
+        expectedIncludes = {os.path.normcase(os.path.abspath(p)) for p in [header1, header2]}
+
+        includesSet, newCompilerOutput = clcache.parseIncludesSet(compilerOutput, sourceFile, strip=False)
+        self.assertEqual(includesSet, expectedIncludes)
+        self.assertEqual(newCompilerOutput, compilerOutput)
+
+        includesSet, newCompilerOutput = clcache.parseIncludesSet(compilerOutput, sourceFile, strip=True)
+        self.assertEqual(includesSet, expectedIncludes)
+        self.assertEqual(newCompilerOutput,
+                         "main.cpp\nmain.cpp(3): warning C4101: 'x': unreferenced local variable\n")
+
     def testParseIncludesGerman(self):
         sample = self._readSampleFileDefault(lang="de")
         includesSet, _ = clcache.parseIncludesSet(
@@ -1054,6 +1232,24 @@ class TestPersistentJSONDict(unittest.TestCase):
         brokenJson = os.path.join(ASSETS_DIR, "broken_json.txt")
         PersistentJSONDict(brokenJson)
 
+    def testSaveOnlyWhenChanged(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            fileName = os.path.join(tempDir, "dict.json")
+            d = PersistentJSONDict(fileName)
+            d["key"] = 1
+            d.save()
+            self.assertTrue(os.path.exists(fileName))
+
+            d = PersistentJSONDict(fileName)
+            d["key"] = 1
+            os.remove(fileName)
+            d.save()
+            self.assertFalse(os.path.exists(fileName))
+
+            d["key"] = 2
+            d.save()
+            self.assertEqual(PersistentJSONDict(fileName)["key"], 2)
+
 
 class TestMemcacheStrategy(unittest.TestCase):
     def testSetGet(self):
@@ -1135,9 +1331,9 @@ class TestCompression(unittest.TestCase):
             with open(srcFilePath, "wb") as f:
                 for i in range(0, 999):
                     f.write(b"%d" % i)
-            copyOrLink(srcFilePath, dstFilePath, True)
-            size = os.path.getsize(dstFilePath)
+            size = copyOrLink(srcFilePath, dstFilePath, True)
             self.assertEqual(size, expectedSize)
+            self.assertEqual(os.path.getsize(dstFilePath), expectedSize)
 
     def testCompression(self):
         os.environ["CLCACHE_COMPRESS"] = "1"
@@ -1162,11 +1358,31 @@ class TestCompression(unittest.TestCase):
             with open(srcFilePath, "wb") as f:
                 f.write(b"Content")
             copyOrLink(srcFilePath, tmpFilePath, True)
-            copyOrLink(tmpFilePath, dstFilePath)
+            self.assertEqual(copyOrLink(tmpFilePath, dstFilePath), os.path.getsize(srcFilePath))
             self.assertNotEqual(os.path.getsize(srcFilePath), os.path.getsize(tmpFilePath))
             self.assertEqual(os.path.getsize(srcFilePath), os.path.getsize(dstFilePath))
 
 
+class TestHardlinking(unittest.TestCase):
+    def setUp(self):
+        self.testDir = tempfile.mkdtemp()
+        os.environ["CLCACHE_HARDLINK"] = "1"
+
+    def tearDown(self):
+        shutil.rmtree(self.testDir)
+        del os.environ["CLCACHE_HARDLINK"]
+
+    def testHardlink(self):
+        from clcache.__main__ import copyOrLink
+
+        srcFilePath = os.path.join(self.testDir, "src")
+        dstFilePath = os.path.join(self.testDir, "dst")
+        with open(srcFilePath, "wb") as f:
+            f.write(b"Content")
+        copyOrLink(srcFilePath, dstFilePath)
+        self.assertTrue(os.path.samefile(srcFilePath, dstFilePath))
+
+
 if __name__ == '__main__':
     unittest.TestCase.longMessage = True
     unittest.main()